@@ -4,11 +4,18 @@ Proxy Backend con Playwright para Web Scraping
 Maneja sitios con JavaScript, Cloudflare, y otras protecciones avanzadas.
 """
 
-from flask import Flask, request, jsonify
-from flask_cors import CORS
+from quart import Quart, Response, request
+import os
 import asyncio
 import aiohttp
-import random
+import orjson
+from cachetools import TTLCache
+import sys
+import zlib
+import hashlib
+import gzip
+import functools
+from types import MappingProxyType
 from urllib.parse import urlparse
 from playwright.async_api import async_playwright
 import logging
@@ -17,76 +24,198 @@ import logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = Flask(__name__)
-CORS(app)  # Permitir requests desde cualquier origen
+# uvloop como event loop (opcional: no disponible en Windows)
+try:
+    import uvloop
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+except ImportError:
+    pass
+
+# Brotli para comprimir respuestas (opcional: si falta se usa solo gzip)
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Tamaño máximo del cuerpo leído por aiohttp (2 MiB por defecto)
+MAX_BODY_BYTES = int(os.environ.get('SCRAPE_MAX_BYTES', 2 * 1024 * 1024))
+
+# Resolución DNS asíncrona (aiodns) contra estos servidores
+DNS_NAMESERVERS = os.environ.get('SCRAPE_DNS_NAMESERVERS', '1.1.1.1,8.8.8.8').split(',')
+
+# Cache en memoria de scrapes exitosos
+CACHE_TTL = int(os.environ.get('SCRAPE_CACHE_TTL', 300))
+# Presupuesto de memoria de la cache (por defecto 64 MiB de contenido)
+CACHE_MAX_BYTES = int(os.environ.get('SCRAPE_CACHE_BYTES', 64 * 1024 * 1024))
+
+# Compresión de respuestas
+COMPRESS_MIN_SIZE = 1024
+COMPRESS_ALGORITHMS = ['br', 'gzip'] if brotli else ['gzip']
+
+# CORS: cualquier origen, preflight cacheado 24h por el navegador
+CORS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'GET,POST,OPTIONS',
+    'Access-Control-Allow-Headers': 'Content-Type, If-None-Match',
+    'Access-Control-Expose-Headers': 'ETag, X-Scrape-Status-Code, X-Scrape-Url, X-Scrape-Method, X-Scrape-Truncated',
+    'Access-Control-Max-Age': '86400'
+}
+
+app = Quart(__name__)
+
+@functools.lru_cache(maxsize=256)
+def _natural_headers_for(domain: str) -> MappingProxyType:
+    """Headers base (sin User-Agent) para un dominio, cacheados e inmutables."""
+    headers = {
+        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8',
+        'Accept-Language': 'es-ES,es;q=0.9,en;q=0.8',
+        'Accept-Encoding': 'gzip, deflate, br',
+        'Connection': 'keep-alive',
+        'Upgrade-Insecure-Requests': '1',
+        'Sec-Fetch-Dest': 'document',
+        'Sec-Fetch-Mode': 'navigate',
+        'Sec-Fetch-User': '?1'
+    }
+    
+    # Simular navegación natural desde Google
+    if 'etsy.com' in domain:
+        headers.update({
+            'Referer': 'https://www.google.com/',
+            'Sec-Fetch-Site': 'cross-site'
+        })
+    elif 'gumroad.com' in domain:
+        headers.update({
+            'Referer': 'https://www.google.com/',
+            'Sec-Fetch-Site': 'cross-site'
+        })
+    else:
+        headers['Sec-Fetch-Site'] = 'none'
+    
+    return MappingProxyType(headers)
+
+async def _read_body(response: aiohttp.ClientResponse, max_bytes: int) -> tuple:
+    """
+    Leer como máximo max_bytes del cuerpo de la respuesta.
+    
+    Decodifica con el charset declarado (o UTF-8) sin la detección de
+    charset de response.text(). Devuelve (contenido, truncado).
+    """
+    body = bytearray()
+    while len(body) < max_bytes:
+        chunk = await response.content.read(max_bytes - len(body))
+        if not chunk:
+            break
+        body.extend(chunk)
+    
+    # at_eof() es False si el body mide justo max_bytes y aún no se leyó el EOF
+    # (p.ej. chunked): leer un byte más para saber si quedaba contenido
+    truncated = len(body) >= max_bytes and bool(await response.content.read(1))
+    try:
+        return body.decode(response.charset or 'utf-8', errors='replace'), truncated
+    except LookupError:
+        return body.decode('utf-8', errors='replace'), truncated
+
+def _etag(content: str) -> str:
+    """ETag (débil) del contenido scrapeado."""
+    return hashlib.blake2b(content.encode('utf-8'), digest_size=16).hexdigest()
+
+def _cache_size(result: dict) -> int:
+    """Memoria ocupada por el contenido de un resultado (str de 1, 2 o 4 bytes por carácter)."""
+    return sys.getsizeof(result['content'])
+
+def _is_cacheable(result: dict) -> bool:
+    """Solo se cachean scrapes exitosos con status 2xx."""
+    return result['success'] and 200 <= result['status_code'] < 300
 
 class ProxyScraper:
     """Scraper que actúa como proxy intermedio."""
     
     def __init__(self):
-        self.user_agents = [
+        self.user_agents = (
             'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
             'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
             'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
-        ]
+        )
+        self._session = None
+        self._session_lock = asyncio.Lock()
+        # Límite de scrapes simultáneos (backpressure para batch)
+        self._sem = asyncio.Semaphore(int(os.environ.get('SCRAPE_CONCURRENCY', 8)))
+        self._cache = TTLCache(maxsize=CACHE_MAX_BYTES, ttl=CACHE_TTL, getsizeof=_cache_size)
+    
+    async def _get_session(self) -> aiohttp.ClientSession:
+        """Obtener la sesión aiohttp compartida (pool de conexiones, DNS y TLS reutilizados)."""
+        if self._session is None or self._session.closed:
+            async with self._session_lock:
+                if self._session is None or self._session.closed:
+                    self._session = aiohttp.ClientSession(
+                        timeout=aiohttp.ClientTimeout(total=30),
+                        connector=aiohttp.TCPConnector(
+                            resolver=aiohttp.AsyncResolver(nameservers=DNS_NAMESERVERS),
+                            use_dns_cache=True,
+                            ttl_dns_cache=600,
+                            limit=64,
+                            limit_per_host=8,
+                            ssl=False
+                        )
+                    )
+        
+        return self._session
+    
+    async def close_session(self):
+        """Cerrar la sesión aiohttp compartida."""
+        if self._session and not self._session.closed:
+            await self._session.close()
+        self._session = None
+    
+    def _user_agent_index(self, url: str) -> int:
+        """Índice de User-Agent fijo por origen (mismo UA para un dominio en todos los procesos)."""
+        return zlib.crc32(urlparse(url).netloc.lower().encode('utf-8')) % len(self.user_agents)
     
     def get_natural_headers(self, url: str) -> dict:
         """Headers que parecen venir de un navegador real."""
-        parsed = urlparse(url)
-        domain = parsed.netloc.lower()
+        domain = urlparse(url).netloc.lower()
+        return {**_natural_headers_for(domain), 'User-Agent': self.user_agents[self._user_agent_index(url)]}
+    
+    async def fetch_url(self, url: str, max_bytes: int = MAX_BODY_BYTES) -> dict:
+        """Fetch URL content and return structured response."""
+        key = (url, max_bytes)
+        cached = self._cache.get(key)
+        if cached is not None:
+            return cached
         
-        headers = {
-            'User-Agent': random.choice(self.user_agents),
-            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8',
-            'Accept-Language': 'es-ES,es;q=0.9,en;q=0.8',
-            'Accept-Encoding': 'gzip, deflate, br',
-            'Connection': 'keep-alive',
-            'Upgrade-Insecure-Requests': '1',
-            'Sec-Fetch-Dest': 'document',
-            'Sec-Fetch-Mode': 'navigate',
-            'Sec-Fetch-User': '?1'
-        }
+        async with self._sem:
+            result = await self._fetch_url(url, max_bytes)
         
-        # Simular navegación natural desde Google
-        if 'etsy.com' in domain:
-            headers.update({
-                'Referer': 'https://www.google.com/',
-                'Sec-Fetch-Site': 'cross-site'
-            })
-        elif 'gumroad.com' in domain:
-            headers.update({
-                'Referer': 'https://www.google.com/',
-                'Sec-Fetch-Site': 'cross-site'
-            })
-        else:
-            headers['Sec-Fetch-Site'] = 'none'
+        if _is_cacheable(result):
+            result['etag'] = _etag(result['content'])
+            # Un contenido mayor que todo el presupuesto no entra en la cache
+            if _cache_size(result) <= CACHE_MAX_BYTES:
+                self._cache[key] = result
         
-        return headers
+        return result
     
-    async def fetch_url(self, url: str) -> dict:
-        """Fetch URL content and return structured response."""
+    async def _fetch_url(self, url: str, max_bytes: int) -> dict:
+        """Fetch URL sin control de concurrencia."""
         try:
-            timeout = aiohttp.ClientTimeout(total=30)
+            session = await self._get_session()
+            headers = self.get_natural_headers(url)
             
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                headers = self.get_natural_headers(url)
+            async with session.get(
+                url, 
+                headers=headers,
+                allow_redirects=True
+            ) as response:
+                
+                content, truncated = await _read_body(response, max_bytes)
                 
-                async with session.get(
-                    url, 
-                    headers=headers,
-                    allow_redirects=True,
-                    ssl=False
-                ) as response:
-                    
-                    content = await response.text()
-                    
-                    return {
-                        'success': True,
-                        'status_code': response.status,
-                        'content': content,
-                        'headers': dict(response.headers),
-                        'url': str(response.url)
-                    }
+                return {
+                    'success': True,
+                    'status_code': response.status,
+                    'content': content,
+                    'truncated': truncated,
+                    'headers': dict(response.headers),
+                    'url': str(response.url)
+                }
         
         except Exception as e:
             return {
@@ -95,76 +224,203 @@ class ProxyScraper:
                 'status_code': 0
             }
 
+class HealthCheckMiddleware:
+    """
+    Middleware ASGI que responde GET/HEAD /health antes del router de Quart.
+    
+    La respuesta se construye una sola vez: los probes de liveness no pasan
+    por routing, hooks ni serialización.
+    """
+    
+    def __init__(self, asgi_app, body: bytes):
+        self.asgi_app = asgi_app
+        self.body = body
+        self.headers = [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(body)).encode('ascii')),
+            (b'cache-control', b'no-store')
+        ]
+        # Los hooks after_request no corren aquí: añadir CORS a mano
+        self.headers.extend(
+            (name.lower().encode('latin-1'), value.encode('latin-1'))
+            for name, value in CORS_HEADERS.items()
+        )
+    
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http' and scope['path'] == '/health' and scope['method'] in ('GET', 'HEAD'):
+            await send({'type': 'http.response.start', 'status': 200, 'headers': self.headers})
+            await send({'type': 'http.response.body', 'body': b'' if scope['method'] == 'HEAD' else self.body})
+            return
+        
+        await self.asgi_app(scope, receive, send)
+
+def _json_response(payload, status: int = 200) -> Response:
+    """Respuesta JSON serializada con orjson."""
+    return Response(
+        orjson.dumps(payload, option=orjson.OPT_NON_STR_KEYS),
+        status=status,
+        mimetype='application/json'
+    )
+
+async def _get_json_body():
+    """Parsear el body JSON con orjson (None si falta o es inválido)."""
+    try:
+        return orjson.loads(await request.get_data(cache=False))
+    except orjson.JSONDecodeError:
+        return None
+
+def _with_cache_headers(response: Response, result: dict) -> Response:
+    """Añadir ETag débil y headers de cache HTTP si el resultado es cacheable."""
+    if result.get('etag'):
+        response.set_etag(result['etag'], weak=True)
+        response.headers['Cache-Control'] = f'public, max-age={CACHE_TTL}, s-maxage={CACHE_TTL}'
+        response.vary.add('Accept-Encoding')
+    return response
+
+def _raw_response(result: dict) -> Response:
+    """Devolver el HTML tal cual, con los metadatos del scrape en headers."""
+    headers = {
+        'X-Scrape-Status-Code': str(result['status_code']),
+        'X-Scrape-Url': result['url'],
+        'X-Scrape-Truncated': 'true' if result.get('truncated') else 'false'
+    }
+    if 'method' in result:
+        headers['X-Scrape-Method'] = result['method']
+    
+    return Response(result['content'], mimetype='text/html', headers=headers)
+
+def _interleave_by_origin(urls: list) -> list:
+    """
+    Orden de índices que alterna entre orígenes (netloc).
+    
+    Así las tareas de un batch no se concentran en un mismo host y cada
+    origen reutiliza sus conexiones keep-alive dentro del límite por host.
+    """
+    by_origin = {}
+    for index, url in enumerate(urls):
+        by_origin.setdefault(urlparse(str(url)).netloc.lower(), []).append(index)
+    
+    groups = list(by_origin.values())
+    order = []
+    for position in range(max(len(group) for group in groups)):
+        order.extend(group[position] for group in groups if position < len(group))
+    
+    return order
+
 proxy_scraper = ProxyScraper()
 
-@app.route('/health', methods=['GET'])
-def health_check():
-    """Health check endpoint."""
-    return jsonify({'status': 'healthy', 'service': 'proxy-scraper'})
+# Health check: respuesta precalculada servida por el middleware
+_HEALTH_BYTES = orjson.dumps({'status': 'healthy', 'service': 'proxy-scraper'})
+app.asgi_app = HealthCheckMiddleware(app.asgi_app, _HEALTH_BYTES)
 
 @app.route('/scrape', methods=['POST'])
-def scrape_url():
+async def scrape_url():
     """
     Scrape a URL and return the content.
     
     Body: {"url": "https://example.com"}
+    
+    Con ?raw=true se devuelve el HTML directamente (text/html) y los
+    metadatos en headers X-Scrape-*, sin envolverlo en JSON.
     """
-    data = request.get_json()
+    data = await _get_json_body()
+    
+    if not isinstance(data, dict) or 'url' not in data:
+        return _json_response({'error': 'URL is required'}, 400)
     
-    if not data or 'url' not in data:
-        return jsonify({'error': 'URL is required'}), 400
+    if not isinstance(data['url'], str):
+        return _json_response({'error': 'URL must be a string'}, 400)
     
     url = data['url']
     
-    # Ejecutar el scraping asíncrono
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
+    result = await proxy_scraper.fetch_url(url)
     
-    try:
-        result = loop.run_until_complete(proxy_scraper.fetch_url(url))
-        return jsonify(result)
-    finally:
-        loop.close()
+    # Request condicional: el cliente ya tiene este contenido
+    etag = result.get('etag')
+    if etag and request.if_none_match.contains_weak(etag):
+        return _with_cache_headers(Response(status=304), result)
+    
+    if request.args.get('raw', '').lower() == 'true':
+        if not result['success']:
+            return _json_response(result, 502)
+        return _with_cache_headers(_raw_response(result), result)
+    
+    return _with_cache_headers(_json_response(result), result)
 
 @app.route('/batch-scrape', methods=['POST'])
-def batch_scrape():
+async def batch_scrape():
     """
     Scrape multiple URLs.
     
     Body: {"urls": ["https://example1.com", "https://example2.com"]}
     """
-    data = request.get_json()
+    data = await _get_json_body()
     
-    if not data or 'urls' not in data:
-        return jsonify({'error': 'URLs array is required'}), 400
+    if not isinstance(data, dict) or 'urls' not in data:
+        return _json_response({'error': 'URLs array is required'}, 400)
     
     urls = data['urls']
     
     if not isinstance(urls, list) or len(urls) == 0:
-        return jsonify({'error': 'URLs must be a non-empty array'}), 400
+        return _json_response({'error': 'URLs must be a non-empty array'}, 400)
+    
+    if not all(isinstance(url, str) for url in urls):
+        return _json_response({'error': 'URLs must be strings'}, 400)
     
     if len(urls) > 10:  # Límite de seguridad
-        return jsonify({'error': 'Maximum 10 URLs allowed'}), 400
+        return _json_response({'error': 'Maximum 10 URLs allowed'}, 400)
     
-    # Scraping en batch
-    async def fetch_all():
-        tasks = [proxy_scraper.fetch_url(url) for url in urls]
-        return await asyncio.gather(*tasks)
+    # Scraping en batch (mismo event loop y sesión compartida); el semáforo
+    # del scraper limita la concurrencia y el orden alterna entre orígenes
+    order = _interleave_by_origin(urls)
+    tasks = [proxy_scraper.fetch_url(urls[index]) for index in order]
+    results = [None] * len(urls)
+    for index, result in zip(order, await asyncio.gather(*tasks)):
+        results[index] = result
     
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
+    return _json_response({
+        'results': dict(zip(urls, results)),
+        'total': len(urls)
+    })
+
+@app.after_request
+async def add_cors_headers(response):
+    """Añadir los headers CORS (estáticos, iguales para cualquier origen)."""
+    response.headers.update(CORS_HEADERS)
+    return response
+
+@app.after_request
+async def compress_response(response):
+    """Comprimir respuestas grandes con brotli o gzip según Accept-Encoding."""
+    if response.status_code != 200 or 'Content-Encoding' in response.headers:
+        return response
     
-    try:
-        results = loop.run_until_complete(fetch_all())
-        return jsonify({
-            'results': dict(zip(urls, results)),
-            'total': len(urls)
-        })
-    finally:
-        loop.close()
+    encoding = request.accept_encodings.best_match(COMPRESS_ALGORITHMS)
+    if encoding is None:
+        return response
+    
+    data = await response.get_data()
+    if len(data) < COMPRESS_MIN_SIZE:
+        return response
+    
+    # Comprimir fuera del event loop (bodies de varios MB)
+    if encoding == 'br':
+        compressed = await asyncio.to_thread(brotli.compress, data, quality=5)
+    else:
+        compressed = await asyncio.to_thread(gzip.compress, data, 6)
+    
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    return response
+
+# Cleanup al cerrar la aplicación (en el mismo event loop que sirve los requests)
+@app.after_serving
+async def cleanup():
+    """Limpiar recursos al cerrar."""
+    await proxy_scraper.close_session()
 
 if __name__ == '__main__':
-    import os
     port = int(os.environ.get('PORT', 8080))
     
     print("🚀 Starting Proxy Scraper Backend")
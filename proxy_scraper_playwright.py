@@ -4,127 +4,384 @@ Proxy Backend con Playwright para Web Scraping
 Maneja sitios con JavaScript, Cloudflare, y otras protecciones avanzadas.
 """
 
-from flask import Flask, request, jsonify
-from flask_cors import CORS
+from quart import Quart, Response, request
+import os
+import re
 import asyncio
 import aiohttp
-import random
+import orjson
+from cachetools import TTLCache
+import sys
+import zlib
+import contextlib
+import hashlib
+import gzip
+import functools
 import json
+from types import MappingProxyType
 from urllib.parse import urlparse
-from playwright.async_api import async_playwright
+from playwright.async_api import async_playwright, TimeoutError as PlaywrightTimeoutError
 import logging
 
 # Configurar logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = Flask(__name__)
-CORS(app)  # Permitir requests desde cualquier origen
+# uvloop como event loop (opcional: no disponible en Windows)
+try:
+    import uvloop
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+except ImportError:
+    pass
+
+# Brotli para comprimir respuestas (opcional: si falta se usa solo gzip)
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Tamaño máximo del cuerpo leído por aiohttp (2 MiB por defecto)
+MAX_BODY_BYTES = int(os.environ.get('SCRAPE_MAX_BYTES', 2 * 1024 * 1024))
+
+# Resolución DNS asíncrona (aiodns) contra estos servidores
+DNS_NAMESERVERS = os.environ.get('SCRAPE_DNS_NAMESERVERS', '1.1.1.1,8.8.8.8').split(',')
+
+# Cache en memoria de scrapes exitosos
+CACHE_TTL = int(os.environ.get('SCRAPE_CACHE_TTL', 300))
+# Presupuesto de memoria de la cache (por defecto 64 MiB de contenido)
+CACHE_MAX_BYTES = int(os.environ.get('SCRAPE_CACHE_BYTES', 64 * 1024 * 1024))
+
+# Compresión de respuestas
+COMPRESS_MIN_SIZE = 1024
+COMPRESS_ALGORITHMS = ['br', 'gzip'] if brotli else ['gzip']
+
+# CORS: cualquier origen, preflight cacheado 24h por el navegador
+CORS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'GET,POST,OPTIONS',
+    'Access-Control-Allow-Headers': 'Content-Type, If-None-Match',
+    'Access-Control-Expose-Headers': 'ETag, X-Scrape-Status-Code, X-Scrape-Url, X-Scrape-Method, X-Scrape-Truncated',
+    'Access-Control-Max-Age': '86400'
+}
+
+app = Quart(__name__)
+
+# Sitios que sabemos que requieren JavaScript
+JS_REQUIRED_DOMAINS = frozenset({
+    'etsy.com',
+    'amazon.com',
+    'ebay.com',
+    'shopify.com',
+    'bigcommerce.com'
+})
+
+# Indicadores de bloqueo, compilados en una sola alternancia (una pasada sobre el HTML)
+BLOCKING_INDICATORS = (
+    'Please enable JS and disable any ad blocker',
+    'captcha-delivery.com',
+    'cloudflare',
+    'just a moment',
+    'checking your browser',
+    'ddos protection by cloudflare',
+    'access denied',
+    'blocked'
+)
+_BLOCK_RE = re.compile('|'.join(map(re.escape, BLOCKING_INDICATORS)), re.IGNORECASE)
+
+# Flags de Chromium (se suman a los de Playwright, que ya desactivan el
+# trabajo en segundo plano y silencian el audio en headless)
+CHROMIUM_ARGS = [
+    '--no-sandbox',
+    '--disable-setuid-sandbox',
+    '--disable-dev-shm-usage',
+    '--disable-accelerated-2d-canvas',
+    '--no-first-run',
+    '--no-zygote',
+    '--disable-gpu'
+]
+
+# Páginas de Playwright pre-creadas por contexto
+PAGES_PER_CONTEXT = int(os.environ.get('PLAYWRIGHT_PAGES_PER_CONTEXT', 2))
+
+# Carrera aiohttp/Playwright: retraso antes de arrancar Playwright y
+# tiempo que se recuerda el método ganador por dominio
+RACE_DELAY = 0.5
+STRATEGY_TTL = int(os.environ.get('SCRAPE_STRATEGY_TTL', 3600))
+
+# Los bloqueos se señalan por status o en los primeros KB del HTML
+BLOCKED_STATUS_CODES = frozenset({403, 429, 503})
+BLOCK_PREVIEW_SIZE = 16 * 1024
+
+@functools.lru_cache(maxsize=256)
+def _natural_headers_for(domain: str) -> MappingProxyType:
+    """Headers base (sin User-Agent) para un dominio, cacheados e inmutables."""
+    headers = {
+        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8',
+        'Accept-Language': 'es-ES,es;q=0.9,en;q=0.8',
+        'Accept-Encoding': 'gzip, deflate, br',
+        'Connection': 'keep-alive',
+        'Upgrade-Insecure-Requests': '1',
+        'Sec-Fetch-Dest': 'document',
+        'Sec-Fetch-Mode': 'navigate',
+        'Sec-Fetch-User': '?1'
+    }
+    
+    # Simular navegación natural desde Google
+    if 'etsy.com' in domain:
+        headers.update({
+            'Referer': 'https://www.google.com/',
+            'Sec-Fetch-Site': 'cross-site'
+        })
+    elif 'gumroad.com' in domain:
+        headers.update({
+            'Referer': 'https://www.google.com/',
+            'Sec-Fetch-Site': 'cross-site'
+        })
+    else:
+        headers['Sec-Fetch-Site'] = 'none'
+    
+    return MappingProxyType(headers)
+
+@functools.lru_cache(maxsize=1024)
+def _domain_needs_playwright(domain: str) -> bool:
+    """Clasificación de dominio cacheada por netloc."""
+    return any(js_domain in domain for js_domain in JS_REQUIRED_DOMAINS)
+
+# Recursos que no aportan al HTML: se abortan en el navegador
+BLOCKED_RESOURCE_TYPES = frozenset({'image', 'media', 'font', 'stylesheet'})
+
+async def _block_heavy_resources(route):
+    """Abortar imágenes, media, fuentes y CSS; dejar pasar el resto."""
+    if route.request.resource_type in BLOCKED_RESOURCE_TYPES:
+        await route.abort()
+    else:
+        await route.continue_()
+
+async def _read_body(response: aiohttp.ClientResponse, max_bytes: int) -> tuple:
+    """
+    Leer como máximo max_bytes del cuerpo de la respuesta.
+    
+    Decodifica con el charset declarado (o UTF-8) sin la detección de
+    charset de response.text(). Devuelve (contenido, truncado).
+    """
+    body = bytearray()
+    while len(body) < max_bytes:
+        chunk = await response.content.read(max_bytes - len(body))
+        if not chunk:
+            break
+        body.extend(chunk)
+    
+    # at_eof() es False si el body mide justo max_bytes y aún no se leyó el EOF
+    # (p.ej. chunked): leer un byte más para saber si quedaba contenido
+    truncated = len(body) >= max_bytes and bool(await response.content.read(1))
+    try:
+        return body.decode(response.charset or 'utf-8', errors='replace'), truncated
+    except LookupError:
+        return body.decode('utf-8', errors='replace'), truncated
+
+def _etag(content: str) -> str:
+    """ETag (débil) del contenido scrapeado."""
+    return hashlib.blake2b(content.encode('utf-8'), digest_size=16).hexdigest()
+
+def _cache_size(result: dict) -> int:
+    """Memoria ocupada por el contenido de un resultado (str de 1, 2 o 4 bytes por carácter)."""
+    return sys.getsizeof(result['content'])
+
+def _is_cacheable(result: dict) -> bool:
+    """Solo se cachean scrapes exitosos con status 2xx."""
+    return result['success'] and 200 <= result['status_code'] < 300
 
 class PlaywrightProxyScraper:
     """Scraper avanzado que usa Playwright para manejar JavaScript."""
     
     def __init__(self):
-        self.user_agents = [
+        self.user_agents = (
             'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
             'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
             'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
-        ]
+        )
         self.playwright = None
         self.browser = None
+        self._contexts = []
+        self._pages = []
+        self._playwright_lock = asyncio.Lock()
+        self._session = None
+        self._session_lock = asyncio.Lock()
+        # Límite de scrapes simultáneos (backpressure para batch)
+        self._sem = asyncio.Semaphore(int(os.environ.get('SCRAPE_CONCURRENCY', 8)))
+        self._cache = TTLCache(maxsize=CACHE_MAX_BYTES, ttl=CACHE_TTL, getsizeof=_cache_size)
+        # Método ganador aprendido por dominio: 'aiohttp' o 'playwright'
+        self._strategies = TTLCache(maxsize=1024, ttl=STRATEGY_TTL)
+        self._background_tasks = set()
+    
+    async def _get_session(self) -> aiohttp.ClientSession:
+        """Obtener la sesión aiohttp compartida (pool de conexiones, DNS y TLS reutilizados)."""
+        if self._session is None or self._session.closed:
+            async with self._session_lock:
+                if self._session is None or self._session.closed:
+                    self._session = aiohttp.ClientSession(
+                        timeout=aiohttp.ClientTimeout(total=30),
+                        connector=aiohttp.TCPConnector(
+                            resolver=aiohttp.AsyncResolver(nameservers=DNS_NAMESERVERS),
+                            use_dns_cache=True,
+                            ttl_dns_cache=600,
+                            limit=64,
+                            limit_per_host=8,
+                            ssl=False
+                        )
+                    )
+        
+        return self._session
+    
+    async def close_session(self):
+        """Cerrar la sesión aiohttp compartida."""
+        if self._session and not self._session.closed:
+            await self._session.close()
+        self._session = None
     
     async def initialize_playwright(self):
         """Inicializar Playwright si no está ya inicializado."""
-        if self.playwright is None:
+        if self.playwright is not None:
+            return
+        
+        async with self._playwright_lock:
+            if self.playwright is not None:
+                return
+            
             logger.info("🎭 Initializing Playwright...")
-            self.playwright = await async_playwright().start()
-            self.browser = await self.playwright.chromium.launch(
-                headless=True,
-                args=[
-                    '--no-sandbox',
-                    '--disable-setuid-sandbox',
-                    '--disable-dev-shm-usage',
-                    '--disable-accelerated-2d-canvas',
-                    '--no-first-run',
-                    '--no-zygote',
-                    '--disable-gpu'
-                ]
-            )
+            playwright = await async_playwright().start()
+            
+            try:
+                self.browser = await playwright.chromium.launch(
+                    headless=True,
+                    args=CHROMIUM_ARGS,
+                    ignore_default_args=['--enable-automation']
+                )
+                
+                # Un contexto persistente por User-Agent (se evita el arranque de contexto por request)
+                self._contexts = []
+                for user_agent in self.user_agents:
+                    self._contexts.append(await self.browser.new_context(
+                        user_agent=user_agent,
+                        viewport={'width': 1280, 'height': 800}
+                    ))
+                for context in self._contexts:
+                    await context.route('**/*', _block_heavy_resources)
+                
+                # Pool de páginas pre-creadas por contexto (limita además la concurrencia por contexto)
+                self._pages = []
+                for context in self._contexts:
+                    pool = asyncio.Queue()
+                    for _ in range(PAGES_PER_CONTEXT):
+                        pool.put_nowait(await self._create_page(context))
+                    self._pages.append(pool)
+            except BaseException:
+                # Inicialización a medias: cerrar lo creado y el driver, para no dejar procesos huérfanos
+                logger.error("❌ Playwright initialization failed, cleaning up")
+                for context in self._contexts:
+                    with contextlib.suppress(Exception):
+                        await context.close()
+                if self.browser:
+                    with contextlib.suppress(Exception):
+                        await self.browser.close()
+                with contextlib.suppress(Exception):
+                    await playwright.stop()
+                self._contexts = []
+                self._pages = []
+                self.browser = None
+                raise
+            
+            self.playwright = playwright
             logger.info("✅ Playwright initialized successfully")
     
     async def cleanup_playwright(self):
         """Limpiar recursos de Playwright."""
+        for context in self._contexts:
+            await context.close()
+        self._contexts = []
+        self._pages = []
         if self.browser:
             await self.browser.close()
+            self.browser = None
         if self.playwright:
             await self.playwright.stop()
+            self.playwright = None
+    
+    def _user_agent_index(self, url: str) -> int:
+        """Índice de User-Agent fijo por origen (mismo UA para un dominio en todos los procesos)."""
+        return zlib.crc32(urlparse(url).netloc.lower().encode('utf-8')) % len(self.user_agents)
     
-    def get_natural_headers(self, url: str) -> dict:
-        """Headers que parecen venir de un navegador real."""
-        parsed = urlparse(url)
-        domain = parsed.netloc.lower()
+    async def _create_page(self, context):
+        """Crear una página para el pool."""
+        page = await context.new_page()
+        page.set_default_timeout(30000)  # 30 segundos
+        return page
+    
+    async def _acquire_page(self, url: str) -> tuple:
+        """
+        Tomar una página del pool del contexto cuyo User-Agent corresponde al origen.
         
-        headers = {
-            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8',
-            'Accept-Language': 'es-ES,es;q=0.9,en;q=0.8',
-            'Accept-Encoding': 'gzip, deflate, br',
-            'Connection': 'keep-alive',
-            'Upgrade-Insecure-Requests': '1',
-            'Sec-Fetch-Dest': 'document',
-            'Sec-Fetch-Mode': 'navigate',
-            'Sec-Fetch-User': '?1'
-        }
+        Espera si todas las páginas del contexto están en uso. Devuelve
+        (índice del contexto, página).
+        """
+        index = self._user_agent_index(url)
+        pool = self._pages[index]
+        page = await pool.get()
         
-        # Simular navegación natural desde Google
-        if 'etsy.com' in domain:
-            headers.update({
-                'Referer': 'https://www.google.com/',
-                'Sec-Fetch-Site': 'cross-site'
-            })
-        elif 'gumroad.com' in domain:
-            headers.update({
-                'Referer': 'https://www.google.com/',
-                'Sec-Fetch-Site': 'cross-site'
-            })
-        else:
-            headers['Sec-Fetch-Site'] = 'none'
+        try:
+            if page.is_closed():
+                page = await self._create_page(self._contexts[index])
+            await page.set_extra_http_headers(dict(self.get_natural_headers(url)))
+        except BaseException:
+            pool.put_nowait(page)
+            raise
         
-        return headers
+        return index, page
+    
+    async def _release_page(self, index: int, page):
+        """Devolver la página al pool tras limpiarla (si falla, se recrea en el próximo uso)."""
+        try:
+            await page.goto('about:blank')
+        except Exception:
+            with contextlib.suppress(Exception):
+                await page.close()
+        finally:
+            # Siempre vuelve al pool (incluso si se cancela), o el contexto se quedaría sin páginas
+            self._pages[index].put_nowait(page)
+    
+    def get_natural_headers(self, url: str) -> MappingProxyType:
+        """Headers que parecen venir de un navegador real (sin User-Agent)."""
+        return _natural_headers_for(urlparse(url).netloc.lower())
     
     async def fetch_with_playwright(self, url: str) -> dict:
         """Fetch URL usando Playwright (para sitios con JavaScript)."""
         try:
-            await self.initialize_playwright()
+            # shield: si la tarea se cancela (carrera perdida) la inicialización termina igual
+            await asyncio.shield(self.initialize_playwright())
             
             logger.info(f"🎭 Using Playwright for {url}")
             
-            # Crear contexto del navegador
-            context = await self.browser.new_context(
-                user_agent=random.choice(self.user_agents),
-                viewport={'width': 1920, 'height': 1080},
-                extra_http_headers=self.get_natural_headers(url)
-            )
-            
-            # Crear página
-            page = await context.new_page()
-            
-            # Configurar timeouts
-            page.set_default_timeout(30000)  # 30 segundos
-            
-            # Navegar a la página
-            response = await page.goto(url, wait_until='domcontentloaded')
-            
-            # Esperar un poco para que se cargue el JavaScript
-            await page.wait_for_timeout(3000)
+            # Tomar una página del pool
+            index, page = await self._acquire_page(url)
             
-            # Obtener el contenido HTML final
-            content = await page.content()
-            
-            # Obtener información adicional
-            title = await page.title()
-            final_url = page.url
-            
-            await context.close()
+            try:
+                # Navegar a la página
+                response = await page.goto(url, wait_until='domcontentloaded')
+                
+                # Esperar a que el JavaScript termine de pedir recursos (con tope)
+                try:
+                    await page.wait_for_load_state('networkidle', timeout=8000)
+                except PlaywrightTimeoutError:
+                    pass
+                
+                # Obtener el contenido HTML final
+                content = await page.content()
+                
+                # Obtener información adicional
+                title = await page.title()
+                final_url = page.url
+            finally:
+                await self._release_page(index, page)
             
             return {
                 'success': True,
@@ -144,34 +401,31 @@ class PlaywrightProxyScraper:
                 'method': 'playwright'
             }
     
-    async def fetch_with_aiohttp(self, url: str) -> dict:
+    async def fetch_with_aiohttp(self, url: str, max_bytes: int = MAX_BODY_BYTES) -> dict:
         """Fetch URL usando aiohttp (para sitios simples)."""
         try:
             logger.info(f"🌐 Using aiohttp for {url}")
             
-            timeout = aiohttp.ClientTimeout(total=30)
+            session = await self._get_session()
+            headers = {**self.get_natural_headers(url), 'User-Agent': self.user_agents[self._user_agent_index(url)]}
             
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                headers = self.get_natural_headers(url)
-                headers['User-Agent'] = random.choice(self.user_agents)
+            async with session.get(
+                url, 
+                headers=headers,
+                allow_redirects=True
+            ) as response:
+                
+                content, truncated = await _read_body(response, max_bytes)
                 
-                async with session.get(
-                    url, 
-                    headers=headers,
-                    allow_redirects=True,
-                    ssl=False
-                ) as response:
-                    
-                    content = await response.text()
-                    
-                    return {
-                        'success': True,
-                        'status_code': response.status,
-                        'content': content,
-                        'headers': dict(response.headers),
-                        'url': str(response.url),
-                        'method': 'aiohttp'
-                    }
+                return {
+                    'success': True,
+                    'status_code': response.status,
+                    'content': content,
+                    'truncated': truncated,
+                    'headers': dict(response.headers),
+                    'url': str(response.url),
+                    'method': 'aiohttp'
+                }
         
         except Exception as e:
             logger.error(f"❌ aiohttp error for {url}: {str(e)}")
@@ -184,19 +438,7 @@ class PlaywrightProxyScraper:
     
     def needs_playwright(self, url: str) -> bool:
         """Determinar si una URL necesita Playwright."""
-        parsed = urlparse(url)
-        domain = parsed.netloc.lower()
-        
-        # Sitios que sabemos que requieren JavaScript
-        js_required_domains = [
-            'etsy.com',
-            'amazon.com',
-            'ebay.com',
-            'shopify.com',
-            'bigcommerce.com'
-        ]
-        
-        return any(js_domain in domain for js_domain in js_required_domains)
+        return _domain_needs_playwright(urlparse(url).netloc.lower())
     
     async def fetch_url(self, url: str, force_playwright: bool = False) -> dict:
         """
@@ -206,9 +448,30 @@ class PlaywrightProxyScraper:
             url: URL a scrapear
             force_playwright: Forzar uso de Playwright
         """
+        key = (url, force_playwright)
+        cached = self._cache.get(key)
+        if cached is not None:
+            return cached
+        
+        async with self._sem:
+            result = await self._fetch_url(url, force_playwright)
+        
+        if _is_cacheable(result):
+            result['etag'] = _etag(result['content'])
+            # Un contenido mayor que todo el presupuesto no entra en la cache
+            if _cache_size(result) <= CACHE_MAX_BYTES:
+                self._cache[key] = result
+        
+        return result
+    
+    async def _fetch_url(self, url: str, force_playwright: bool = False) -> dict:
+        """Fetch URL con la estrategia más apropiada, sin control de concurrencia."""
         try:
+            domain = urlparse(url).netloc.lower()
+            strategy = self._strategies.get(domain)
+            
             # Decidir qué método usar
-            if force_playwright or self.needs_playwright(url):
+            if force_playwright or self.needs_playwright(url) or strategy == 'playwright':
                 result = await self.fetch_with_playwright(url)
                 
                 # Si Playwright falla, intentar con aiohttp como fallback
@@ -219,15 +482,21 @@ class PlaywrightProxyScraper:
                         return fallback_result
                 
                 return result
-            else:
+            
+            if strategy == 'aiohttp':
                 result = await self.fetch_with_aiohttp(url)
                 
                 # Si aiohttp falla o detectamos bloqueo, intentar con Playwright
-                if not result['success'] or self._is_blocked_content(result.get('content', '')):
+                if not self._is_usable_aiohttp_result(result):
                     logger.info(f"🔄 aiohttp blocked/failed, trying Playwright for {url}")
-                    return await self.fetch_with_playwright(url)
+                    result = await self.fetch_with_playwright(url)
+                    if result['success']:
+                        self._strategies[domain] = 'playwright'
                 
                 return result
+            
+            # Dominio sin historial: carrera entre ambos métodos
+            return await self._race(url, domain)
         
         except Exception as e:
             logger.error(f"❌ General error for {url}: {str(e)}")
@@ -238,39 +507,154 @@ class PlaywrightProxyScraper:
                 'method': 'error'
             }
     
+    async def _race(self, url: str, domain: str) -> dict:
+        """
+        Carrera aiohttp vs Playwright para un dominio sin historial.
+        
+        aiohttp arranca de inmediato; Playwright solo si aiohttp no ha dado
+        un resultado válido en RACE_DELAY segundos. Gana el primer resultado
+        válido (se cancela el otro) y el método ganador se recuerda para el
+        dominio.
+        """
+        aiohttp_task = asyncio.create_task(self.fetch_with_aiohttp(url))
+        pending = {aiohttp_task}
+        
+        try:
+            done, pending = await asyncio.wait(pending, timeout=RACE_DELAY)
+            if done and self._is_usable_aiohttp_result(aiohttp_task.result()):
+                self._strategies[domain] = 'aiohttp'
+                return aiohttp_task.result()
+            
+            logger.info(f"🏁 aiohttp slow/blocked, racing Playwright for {url}")
+            playwright_task = asyncio.create_task(self.fetch_with_playwright(url))
+            pending.add(playwright_task)
+            
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                
+                if aiohttp_task in done and self._is_usable_aiohttp_result(aiohttp_task.result()):
+                    self._strategies[domain] = 'aiohttp'
+                    return aiohttp_task.result()
+                
+                if playwright_task in done and playwright_task.result()['success']:
+                    self._strategies[domain] = 'playwright'
+                    return playwright_task.result()
+            
+            # Ninguno dio un resultado válido: devolver el de Playwright
+            return playwright_task.result()
+        finally:
+            # Cancelar lo pendiente (perdedor o carrera cancelada) sin esperar su limpieza
+            for task in pending:
+                task.cancel()
+                self._background_tasks.add(task)
+                task.add_done_callback(self._background_tasks.discard)
+    
+    def _is_usable_aiohttp_result(self, result: dict) -> bool:
+        """Resultado de aiohttp válido: sin error, sin status de bloqueo y sin bloqueo en el inicio del HTML."""
+        return (result['success']
+                and result['status_code'] not in BLOCKED_STATUS_CODES
+                and not self._is_blocked_content(result['content'][:BLOCK_PREVIEW_SIZE]))
+    
     def _is_blocked_content(self, content: str) -> bool:
         """Detectar si el contenido está bloqueado."""
-        if not content:
-            return True
-        
-        blocking_indicators = [
-            'Please enable JS and disable any ad blocker',
-            'captcha-delivery.com',
-            'cloudflare',
-            'just a moment',
-            'checking your browser',
-            'ddos protection by cloudflare',
-            'access denied',
-            'blocked'
+        return not content or _BLOCK_RE.search(content) is not None
+
+class HealthCheckMiddleware:
+    """
+    Middleware ASGI que responde GET/HEAD /health antes del router de Quart.
+    
+    La respuesta se construye una sola vez: los probes de liveness no pasan
+    por routing, hooks ni serialización.
+    """
+    
+    def __init__(self, asgi_app, body: bytes):
+        self.asgi_app = asgi_app
+        self.body = body
+        self.headers = [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(body)).encode('ascii')),
+            (b'cache-control', b'no-store')
         ]
+        # Los hooks after_request no corren aquí: añadir CORS a mano
+        self.headers.extend(
+            (name.lower().encode('latin-1'), value.encode('latin-1'))
+            for name, value in CORS_HEADERS.items()
+        )
+    
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http' and scope['path'] == '/health' and scope['method'] in ('GET', 'HEAD'):
+            await send({'type': 'http.response.start', 'status': 200, 'headers': self.headers})
+            await send({'type': 'http.response.body', 'body': b'' if scope['method'] == 'HEAD' else self.body})
+            return
         
-        content_lower = content.lower()
-        return any(indicator in content_lower for indicator in blocking_indicators)
+        await self.asgi_app(scope, receive, send)
+
+def _json_response(payload, status: int = 200) -> Response:
+    """Respuesta JSON serializada con orjson."""
+    return Response(
+        orjson.dumps(payload, option=orjson.OPT_NON_STR_KEYS),
+        status=status,
+        mimetype='application/json'
+    )
+
+async def _get_json_body():
+    """Parsear el body JSON con orjson (None si falta o es inválido)."""
+    try:
+        return orjson.loads(await request.get_data(cache=False))
+    except orjson.JSONDecodeError:
+        return None
+
+def _with_cache_headers(response: Response, result: dict) -> Response:
+    """Añadir ETag débil y headers de cache HTTP si el resultado es cacheable."""
+    if result.get('etag'):
+        response.set_etag(result['etag'], weak=True)
+        response.headers['Cache-Control'] = f'public, max-age={CACHE_TTL}, s-maxage={CACHE_TTL}'
+        response.vary.add('Accept-Encoding')
+    return response
+
+def _raw_response(result: dict) -> Response:
+    """Devolver el HTML tal cual, con los metadatos del scrape en headers."""
+    headers = {
+        'X-Scrape-Status-Code': str(result['status_code']),
+        'X-Scrape-Url': result['url'],
+        'X-Scrape-Truncated': 'true' if result.get('truncated') else 'false'
+    }
+    if 'method' in result:
+        headers['X-Scrape-Method'] = result['method']
+    
+    return Response(result['content'], mimetype='text/html', headers=headers)
+
+def _interleave_by_origin(urls: list) -> list:
+    """
+    Orden de índices que alterna entre orígenes (netloc).
+    
+    Así las tareas de un batch no se concentran en un mismo host y cada
+    origen reutiliza sus conexiones keep-alive dentro del límite por host.
+    """
+    by_origin = {}
+    for index, url in enumerate(urls):
+        by_origin.setdefault(urlparse(str(url)).netloc.lower(), []).append(index)
+    
+    groups = list(by_origin.values())
+    order = []
+    for position in range(max(len(group) for group in groups)):
+        order.extend(group[position] for group in groups if position < len(group))
+    
+    return order
 
 # Instancia global del scraper
 proxy_scraper = PlaywrightProxyScraper()
 
-@app.route('/health', methods=['GET'])
-def health_check():
-    """Health check endpoint."""
-    return jsonify({
-        'status': 'healthy', 
-        'service': 'proxy-scraper-playwright',
-        'features': ['aiohttp', 'playwright', 'javascript-support']
-    })
+# Health check: respuesta precalculada servida por el middleware
+_HEALTH_BYTES = orjson.dumps({
+    'status': 'healthy', 
+    'service': 'proxy-scraper-playwright',
+    'features': ['aiohttp', 'playwright', 'javascript-support']
+})
+app.asgi_app = HealthCheckMiddleware(app.asgi_app, _HEALTH_BYTES)
 
 @app.route('/scrape', methods=['POST'])
-def scrape_url():
+async def scrape_url():
     """
     Scrape a URL and return the content.
     
@@ -278,27 +662,37 @@ def scrape_url():
         "url": "https://example.com",
         "force_playwright": false  // opcional
     }
+    
+    Con ?raw=true se devuelve el HTML directamente (text/html) y los
+    metadatos en headers X-Scrape-*, sin envolverlo en JSON.
     """
-    data = request.get_json()
+    data = await _get_json_body()
+    
+    if not isinstance(data, dict) or 'url' not in data:
+        return _json_response({'error': 'URL is required'}, 400)
     
-    if not data or 'url' not in data:
-        return jsonify({'error': 'URL is required'}), 400
+    if not isinstance(data['url'], str):
+        return _json_response({'error': 'URL must be a string'}, 400)
     
     url = data['url']
-    force_playwright = data.get('force_playwright', False)
+    force_playwright = bool(data.get('force_playwright', False))
     
-    # Ejecutar el scraping asíncrono
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
+    result = await proxy_scraper.fetch_url(url, force_playwright)
     
-    try:
-        result = loop.run_until_complete(proxy_scraper.fetch_url(url, force_playwright))
-        return jsonify(result)
-    finally:
-        loop.close()
+    # Request condicional: el cliente ya tiene este contenido
+    etag = result.get('etag')
+    if etag and request.if_none_match.contains_weak(etag):
+        return _with_cache_headers(Response(status=304), result)
+    
+    if request.args.get('raw', '').lower() == 'true':
+        if not result['success']:
+            return _json_response(result, 502)
+        return _with_cache_headers(_raw_response(result), result)
+    
+    return _with_cache_headers(_json_response(result), result)
 
 @app.route('/batch-scrape', methods=['POST'])
-def batch_scrape():
+async def batch_scrape():
     """
     Scrape multiple URLs.
     
@@ -307,54 +701,75 @@ def batch_scrape():
         "force_playwright": false  // opcional
     }
     """
-    data = request.get_json()
+    data = await _get_json_body()
     
-    if not data or 'urls' not in data:
-        return jsonify({'error': 'URLs array is required'}), 400
+    if not isinstance(data, dict) or 'urls' not in data:
+        return _json_response({'error': 'URLs array is required'}, 400)
     
     urls = data['urls']
-    force_playwright = data.get('force_playwright', False)
+    force_playwright = bool(data.get('force_playwright', False))
     
     if not isinstance(urls, list) or len(urls) == 0:
-        return jsonify({'error': 'URLs must be a non-empty array'}), 400
+        return _json_response({'error': 'URLs must be a non-empty array'}, 400)
     
-    if len(urls) > 5:  # Límite reducido para Playwright
-        return jsonify({'error': 'Maximum 5 URLs allowed for batch scraping'}), 400
+    if not all(isinstance(url, str) for url in urls):
+        return _json_response({'error': 'URLs must be strings'}, 400)
     
-    # Scraping en batch
-    async def fetch_all():
-        tasks = [proxy_scraper.fetch_url(url, force_playwright) for url in urls]
-        return await asyncio.gather(*tasks)
+    if len(urls) > 5:  # Límite reducido para Playwright
+        return _json_response({'error': 'Maximum 5 URLs allowed for batch scraping'}, 400)
     
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
+    # Scraping en batch (mismo event loop, sesión y navegador compartidos); el
+    # semáforo del scraper limita la concurrencia y el orden alterna entre orígenes
+    order = _interleave_by_origin(urls)
+    tasks = [proxy_scraper.fetch_url(urls[index], force_playwright) for index in order]
+    results = [None] * len(urls)
+    for index, result in zip(order, await asyncio.gather(*tasks)):
+        results[index] = result
     
-    try:
-        results = loop.run_until_complete(fetch_all())
-        return jsonify({
-            'results': dict(zip(urls, results)),
-            'total': len(urls)
-        })
-    finally:
-        loop.close()
+    return _json_response({
+        'results': dict(zip(urls, results)),
+        'total': len(urls)
+    })
 
-# Cleanup al cerrar la aplicación
-import atexit
+@app.after_request
+async def add_cors_headers(response):
+    """Añadir los headers CORS (estáticos, iguales para cualquier origen)."""
+    response.headers.update(CORS_HEADERS)
+    return response
 
-def cleanup():
-    """Limpiar recursos al cerrar."""
-    try:
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        loop.run_until_complete(proxy_scraper.cleanup_playwright())
-        loop.close()
-    except:
-        pass
+@app.after_request
+async def compress_response(response):
+    """Comprimir respuestas grandes con brotli o gzip según Accept-Encoding."""
+    if response.status_code != 200 or 'Content-Encoding' in response.headers:
+        return response
+    
+    encoding = request.accept_encodings.best_match(COMPRESS_ALGORITHMS)
+    if encoding is None:
+        return response
+    
+    data = await response.get_data()
+    if len(data) < COMPRESS_MIN_SIZE:
+        return response
+    
+    # Comprimir fuera del event loop (bodies de varios MB)
+    if encoding == 'br':
+        compressed = await asyncio.to_thread(brotli.compress, data, quality=5)
+    else:
+        compressed = await asyncio.to_thread(gzip.compress, data, 6)
+    
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    return response
 
-atexit.register(cleanup)
+# Cleanup al cerrar la aplicación (en el mismo event loop que sirve los requests)
+@app.after_serving
+async def cleanup():
+    """Limpiar recursos al cerrar."""
+    await proxy_scraper.close_session()
+    await proxy_scraper.cleanup_playwright()
 
 if __name__ == '__main__':
-    import os
     port = int(os.environ.get('PORT', 8080))
     
     print("🚀 Starting Playwright Proxy Scraper Backend")
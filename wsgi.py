@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 """
-WSGI entry point for Render deployment.
-This file allows Render to find our Flask app easily.
+ASGI entry point for Render deployment.
+This file allows Render to find our Quart app easily (uvicorn wsgi:app).
 """
 
 from proxy_scraper_playwright import app